@@ -1,18 +1,47 @@
-from fastapi import FastAPI, HTTPException, Depends
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Depends, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from pydantic import BaseModel
-from jose import JWTError, jwt
-from datetime import datetime, timedelta
+from pydantic import BaseModel, ConfigDict
+from jose import JWTError, jwk, jwt as jose_jwt
+from jwt.algorithms import HMACAlgorithm
+import jwt
 import httpx
+import asyncio
+import logging
 import os
+import re
+import time
 import hashlib
+import hmac
 import base64
+import orjson
+from cachetools import TLRUCache, TTLCache
+from urllib.parse import quote_plus, urlencode
 from dotenv import load_dotenv
 
 load_dotenv()
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Shared client so OAuth calls reuse pooled keep-alive connections; HTTP/2
+    # lets concurrent GitHub/Google calls multiplex over a single connection
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=128, keepalive_expiry=30.0),
+        timeout=httpx.Timeout(10.0, connect=5.0)
+    )
+    yield
+    await app.state.http.aclose()
+
+class ORJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 security = HTTPBearer()
 
 app.add_middleware(
@@ -23,73 +52,174 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-JWT_SECRET = os.getenv("JWT_SECRET")
+# Encoded once; PyJWT would otherwise re-encode the str on every sign/verify
+JWT_SECRET_BYTES = os.environ["JWT_SECRET"].encode("utf-8")
 GITHUB_CLIENT_ID = os.getenv("GITHUB_CLIENT_ID")
 GITHUB_CLIENT_SECRET = os.getenv("GITHUB_CLIENT_SECRET")
 GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
 GOOGLE_CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET")
 
+# Static part of the Google token exchange form; only code/verifier vary
+GOOGLE_TOKEN_FORM_PREFIX = urlencode({
+    "client_id": GOOGLE_CLIENT_ID,
+    "client_secret": GOOGLE_CLIENT_SECRET,
+    "grant_type": "authorization_code",
+    "redirect_uri": "http://localhost:5173/auth/google/callback"
+}).encode()
+
+def _b64url(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+# Every token we issue shares the same key and header, so build them once
+HS256 = HMACAlgorithm(HMACAlgorithm.SHA256)
+SIGNING_KEY = HS256.prepare_key(JWT_SECRET_BYTES)
+JWT_HEADER_B64 = _b64url(orjson.dumps({"alg": "HS256", "typ": "JWT"}))
+ACCESS_TOKEN_TTL = 3600
+REFRESH_TOKEN_TTL = 7 * 86400
+
+# Google's signing keys rotate rarely; honour the Cache-Control max-age and
+# keep them as parsed RSA keys indexed by kid
+JWKS_DEFAULT_TTL = 3600
+# An unknown kid may mean Google rotated early; refetch at most this often
+JWKS_MIN_REFETCH_INTERVAL = 60
+_jwks_cache = {"keys_by_kid": None, "expires_at": 0.0, "fetched_at": 0.0}
+_jwks_lock = asyncio.Lock()
+
+# Verified tokens as (payload, /auth/me body), dropped at the token's own exp
+# (or after an hour). Access tokens are keyed by the raw string, refresh tokens
+# by ("refresh", token) with no body
+TOKEN_CACHE_TTL = 3600
+_token_cache = TLRUCache(
+    maxsize=10_000,
+    ttu=lambda _key, entry, now: min(entry[0].get("exp", now), now + TOKEN_CACHE_TTL),
+    timer=time.time
+)
+
+# Digests of tokens that recently failed verification, so replays of the same
+# bad token are rejected without redoing the crypto. Only the hash is kept
+_rejected_tokens = TTLCache(maxsize=10_000, ttl=60)
+
+def _token_digest(token: str) -> bytes:
+    return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+def sign_token(payload: dict) -> str:
+    """Encode and sign an HS256 JWT using the prebuilt header and key"""
+    signing_input = JWT_HEADER_B64 + b"." + _b64url(orjson.dumps(payload))
+    return (signing_input + b"." + _b64url(HS256.sign(signing_input, SIGNING_KEY))).decode()
+
 def create_tokens(user_data: dict):
-    access_payload = {
-        "sub": str(user_data["id"]),
+    """Sign access/refresh tokens and return them with the public user profile"""
+    now = int(time.time())
+    user = {
+        "id": user_data["id"],
         "username": user_data["login"],
         "name": user_data.get("name") or user_data["login"],
         "email": user_data.get("email"),
-        "avatar": user_data.get("avatar_url"),
-        "exp": datetime.utcnow() + timedelta(hours=1)
+        "avatar": user_data.get("avatar_url")
+    }
+    sub = str(user["id"])
+    access_payload = {
+        "sub": sub,
+        "username": user["username"],
+        "name": user["name"],
+        "email": user["email"],
+        "avatar": user["avatar"],
+        "exp": now + ACCESS_TOKEN_TTL
     }
     refresh_payload = {
-        "sub": str(user_data["id"]),
+        "sub": sub,
         "type": "refresh",
-        "exp": datetime.utcnow() + timedelta(days=7)
+        "exp": now + REFRESH_TOKEN_TTL
     }
     
-    access_token = jwt.encode(access_payload, JWT_SECRET, algorithm="HS256")
-    refresh_token = jwt.encode(refresh_payload, JWT_SECRET, algorithm="HS256")
-    
-    return {"access_token": access_token, "refresh_token": refresh_token}
+    return {
+        "user": user,
+        "access_token": sign_token(access_payload),
+        "refresh_token": sign_token(refresh_payload)
+    }
+
+class AuthRequest(BaseModel):
+    # Small immutable payloads; unknown keys are dropped without extra checks
+    model_config = ConfigDict(extra="ignore", frozen=True)
 
-class GitHubAuthRequest(BaseModel):
+class GitHubAuthRequest(AuthRequest):
     code: str
-    state: str = None
+    state: str | None = None
 
-class RefreshTokenRequest(BaseModel):
+class RefreshTokenRequest(AuthRequest):
     refresh_token: str
 
-class GoogleAuthRequest(BaseModel):
+class GoogleAuthRequest(AuthRequest):
     code: str
-    code_verifier: str = None
-    state: str = None
+    code_verifier: str | None = None
+    state: str | None = None
 
 def verify_pkce(code_verifier: str, code_challenge: str) -> bool:
     """Verify PKCE code challenge"""
     if not code_verifier or not code_challenge:
         return True  # Skip verification if not provided
     
-    # Generate challenge from verifier
+    # Generate challenge from verifier and compare the canonical encoding in
+    # constant time; decoding the supplied challenge would accept variants
     digest = hashlib.sha256(code_verifier.encode()).digest()
-    generated_challenge = base64.urlsafe_b64encode(digest).decode().rstrip('=')
+    generated_challenge = base64.urlsafe_b64encode(digest).rstrip(b"=")
     
-    return generated_challenge == code_challenge
+    return hmac.compare_digest(generated_challenge, code_challenge.encode())
+
+def get_http_client(request: Request) -> httpx.AsyncClient:
+    return request.app.state.http
+
+def _max_age(cache_control: str) -> int:
+    match = re.search(r"max-age=(\d+)", cache_control or "")
+    return int(match.group(1)) if match else JWKS_DEFAULT_TTL
 
-async def verify_google_id_token(id_token: str, http_client, access_token: str = None):
+async def _fetch_google_keys(http_client):
+    # Callers hold _jwks_lock
+    jwks_response = await http_client.get("https://www.googleapis.com/oauth2/v3/certs")
+    if jwks_response.status_code != 200:
+        raise HTTPException(500, "Failed to get Google keys")
+    
+    jwks = orjson.loads(jwks_response.content)
+    now = time.monotonic()
+    _jwks_cache["keys_by_kid"] = {k["kid"]: jwk.construct(k, algorithm="RS256") for k in jwks["keys"]}
+    _jwks_cache["expires_at"] = now + _max_age(jwks_response.headers.get("cache-control"))
+    _jwks_cache["fetched_at"] = now
+
+async def get_google_key(http_client, kid: str):
+    """Return Google's public key for kid, refetching once the cached set expires
+    or, rate-limited, when it doesn't know the kid"""
+    if time.monotonic() < _jwks_cache["expires_at"] and kid in _jwks_cache["keys_by_kid"]:
+        return _jwks_cache["keys_by_kid"][kid]
+    
+    async with _jwks_lock:
+        now = time.monotonic()
+        fresh = now < _jwks_cache["expires_at"]
+        # Another request may have refreshed the keys while we waited
+        if fresh and kid in _jwks_cache["keys_by_kid"]:
+            return _jwks_cache["keys_by_kid"][kid]
+        
+        if not fresh or now - _jwks_cache["fetched_at"] >= JWKS_MIN_REFETCH_INTERVAL:
+            await _fetch_google_keys(http_client)
+        return _jwks_cache["keys_by_kid"].get(kid)
+
+async def verify_google_id_token(id_token: str, http_client):
     """Verify Google ID token with proper validation"""
     try:
-        # Get Google's public keys
-        jwks_response = await http_client.get("https://www.googleapis.com/oauth2/v3/certs")
-        if jwks_response.status_code != 200:
-            raise HTTPException(500, "Failed to get Google keys")
+        # Pick the signing key named in the token header
+        kid = jose_jwt.get_unverified_header(id_token).get("kid")
+        key = await get_google_key(http_client, kid)
+        if key is None:
+            raise HTTPException(400, "Invalid ID token: unknown signing key")
         
-        jwks = jwks_response.json()
-        
-        # Verify token with proper at_hash validation
-        user_data = jwt.decode(
+        # Signature, aud, iss and exp are checked. at_hash is skipped: the token
+        # comes straight from Google's token endpoint over TLS, not a browser
+        user_data = jose_jwt.decode(
             id_token,
-            jwks,
+            key,
             algorithms=["RS256"],
             audience=GOOGLE_CLIENT_ID,
             issuer="https://accounts.google.com",
-            access_token=access_token  # Provide access token for at_hash validation
+            options={"verify_at_hash": False}
         )
         
         return user_data
@@ -97,170 +227,183 @@ async def verify_google_id_token(id_token: str, http_client, access_token: str =
     except JWTError as e:
         raise HTTPException(400, f"Invalid ID token: {str(e)}")
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+def verify_access_token(token: str) -> tuple[dict, bytes]:
+    """Return the token payload and its serialised /auth/me response"""
+    entry = _token_cache.get(token)
+    if entry is not None:
+        return entry
+    
+    digest = _token_digest(token)
+    if digest in _rejected_tokens:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    
     try:
-        payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=["HS256"])
-        return payload
-    except JWTError:
+        payload = jwt.decode(token, JWT_SECRET_BYTES, algorithms=["HS256"])
+    except jwt.InvalidTokenError:
+        _rejected_tokens[digest] = True
         raise HTTPException(status_code=401, detail="Invalid token")
+    if payload.get("type") == "refresh":
+        _rejected_tokens[digest] = True
+        raise HTTPException(status_code=401, detail="Invalid token")
+    
+    me = orjson.dumps({
+        "user": {
+            "id": payload["sub"],
+            "username": payload["username"],
+            "name": payload.get("name", payload["username"]),
+            "email": payload.get("email"),
+            "avatar": payload.get("avatar")
+        }
+    })
+    # Only tokens that passed verification are cached
+    entry = _token_cache[token] = (payload, me)
+    return entry
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Return the cached (payload, /auth/me body) entry for the bearer token"""
+    return verify_access_token(credentials.credentials)
 
 @app.post("/auth/github")
-async def github_auth(request: GitHubAuthRequest):
-    async with httpx.AsyncClient() as client:
-        # Exchange code for access token
-        token_response = await client.post(
-            "https://github.com/login/oauth/access_token",
-            data={
-                "client_id": GITHUB_CLIENT_ID,
-                "client_secret": GITHUB_CLIENT_SECRET,
-                "code": request.code,
-            },
-            headers={"Accept": "application/json"}
-        )
-        
-        if token_response.status_code != 200:
-            raise HTTPException(status_code=400, detail="Failed to get access token")
-        
-        token_data = token_response.json()
-        github_token = token_data.get("access_token")
-        
-        # Get user info
-        user_response = await client.get(
-            "https://api.github.com/user",
-            headers={"Authorization": f"Bearer {github_token}"}
-        )
-        
-        if user_response.status_code != 200:
-            raise HTTPException(status_code=400, detail="Failed to get user info")
-        
-        user_data = user_response.json()
-        
-        # Get user email if not public
-        if not user_data.get("email"):
-            email_response = await client.get(
-                "https://api.github.com/user/emails",
-                headers={"Authorization": f"Bearer {github_token}"}
-            )
-            if email_response.status_code == 200:
-                emails = email_response.json()
-                primary_email = next((e["email"] for e in emails if e["primary"]), None)
-                if primary_email:
-                    user_data["email"] = primary_email
-        tokens = create_tokens(user_data)
-        
-        return {
-            "user": {
-                "id": user_data["id"], 
-                "username": user_data["login"],
-                "name": user_data.get("name") or user_data["login"],
-                "email": user_data.get("email"),
-                "avatar": user_data.get("avatar_url")
-            },
-            **tokens
-        }
+async def github_auth(request: GitHubAuthRequest, client: httpx.AsyncClient = Depends(get_http_client)):
+    # Exchange code for access token
+    token_response = await client.post(
+        "https://github.com/login/oauth/access_token",
+        data={
+            "client_id": GITHUB_CLIENT_ID,
+            "client_secret": GITHUB_CLIENT_SECRET,
+            "code": request.code,
+        },
+        headers={"Accept": "application/json"}
+    )
+    
+    if token_response.status_code != 200:
+        raise HTTPException(status_code=400, detail="Failed to get access token")
+    
+    token_data = orjson.loads(token_response.content)
+    github_token = token_data.get("access_token")
+    
+    # Get user info and emails together; emails are only used if not public
+    headers = {"Authorization": f"Bearer {github_token}"}
+    user_response, email_response = await asyncio.gather(
+        client.get("https://api.github.com/user", headers=headers),
+        client.get("https://api.github.com/user/emails", headers=headers)
+    )
+    
+    logger.debug("GitHub user lookup over %s", user_response.http_version)
+    
+    if user_response.status_code != 200:
+        raise HTTPException(status_code=400, detail="Failed to get user info")
+    
+    user_data = orjson.loads(user_response.content)
+    
+    # Get user email if not public
+    if not user_data.get("email") and email_response.status_code == 200:
+        emails = orjson.loads(email_response.content)
+        primary_email = next((e["email"] for e in emails if e["primary"]), None)
+        if primary_email:
+            user_data["email"] = primary_email
+    
+    return create_tokens(user_data)
 
 @app.post("/auth/refresh")
 async def refresh_token(request: RefreshTokenRequest):
-    try:
-        payload = jwt.decode(request.refresh_token, JWT_SECRET, algorithms=["HS256"])
+    cache_key = ("refresh", request.refresh_token)
+    entry = _token_cache.get(cache_key)
+    
+    if entry is not None:
+        payload = entry[0]
+    else:
+        rejected_key = ("refresh", _token_digest(request.refresh_token))
+        if rejected_key in _rejected_tokens:
+            raise HTTPException(status_code=401, detail="Invalid refresh token")
+        try:
+            payload = jwt.decode(request.refresh_token, JWT_SECRET_BYTES, algorithms=["HS256"])
+        except jwt.InvalidTokenError:
+            _rejected_tokens[rejected_key] = True
+            raise HTTPException(status_code=401, detail="Invalid refresh token")
         if payload.get("type") != "refresh":
+            _rejected_tokens[rejected_key] = True
             raise HTTPException(status_code=401, detail="Invalid refresh token")
-        
-        user_data = {
-            "id": payload["sub"], 
-            "login": payload.get("username", ""),
-            "name": payload.get("name", ""),
-            "email": payload.get("email"),
-            "avatar_url": payload.get("avatar")
-        }
-        return create_tokens(user_data)
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid refresh token")
+        _token_cache[cache_key] = (payload, None)
+    
+    user_data = {
+        "id": payload["sub"], 
+        "login": payload.get("username", ""),
+        "name": payload.get("name", ""),
+        "email": payload.get("email"),
+        "avatar_url": payload.get("avatar")
+    }
+    tokens = create_tokens(user_data)
+    
+    # Refresh tokens carry no profile claims, so leave the blank user out
+    return {"access_token": tokens["access_token"], "refresh_token": tokens["refresh_token"]}
 
 @app.post("/auth/google")
-async def google_auth(request: GoogleAuthRequest):
+async def google_auth(request: GoogleAuthRequest, client: httpx.AsyncClient = Depends(get_http_client)):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "Google auth request: code=%s..., verifier=%s...",
+            request.code[:10],
+            request.code_verifier[:10] if request.code_verifier else None
+        )
+    
+    # Prepare token exchange data
+    body = GOOGLE_TOKEN_FORM_PREFIX + b"&code=" + quote_plus(request.code).encode()
+    
+    # Add PKCE verifier if provided
+    if request.code_verifier:
+        body += b"&code_verifier=" + quote_plus(request.code_verifier).encode()
+    
+    # Exchange code for tokens
+    token_response = await client.post(
+        "https://oauth2.googleapis.com/token",
+        content=body,
+        headers={"Content-Type": "application/x-www-form-urlencoded"}
+    )
+    
+    if token_response.status_code != 200:
+        logger.debug("Google token response error: %s - %s", token_response.status_code, token_response.text)
+        raise HTTPException(status_code=400, detail="Failed to get access token")
+    
+    token_data = orjson.loads(token_response.content)
+    logger.debug("Google token response fields: %s", list(token_data))
+    id_token = token_data.get("id_token")
+    
+    if not id_token:
+        raise HTTPException(status_code=400, detail="No ID token received")
+    
+    # Verify ID token
     try:
-        print(f"Google auth request: code={request.code[:10]}..., verifier={request.code_verifier[:10] if request.code_verifier else None}...")
-        async with httpx.AsyncClient() as client:
-            # Prepare token exchange data
-            token_data = {
-                "client_id": GOOGLE_CLIENT_ID,
-                "client_secret": GOOGLE_CLIENT_SECRET,
-                "code": request.code,
-                "grant_type": "authorization_code",
-                "redirect_uri": "http://localhost:5173/auth/google/callback"
-            }
-            
-            # Add PKCE verifier if provided
-            if request.code_verifier:
-                token_data["code_verifier"] = request.code_verifier
-            
-            # Exchange code for tokens
-            token_response = await client.post(
-                "https://oauth2.googleapis.com/token",
-                data=token_data
-            )
+        user_data = await verify_google_id_token(id_token, client)
+        logger.debug("Verified Google user: %s", user_data.get("sub"))
         
-            if token_response.status_code != 200:
-                print(f"Google token response error: {token_response.status_code} - {token_response.text}")
-                raise HTTPException(status_code=400, detail="Failed to get access token")
-            
-            token_data = token_response.json()
-            print(f"Token response: {token_data}")
-            id_token = token_data.get("id_token")
-            
-            if not id_token:
-                raise HTTPException(status_code=400, detail="No ID token received")
-            
-            # Verify ID token
-            try:
-                google_access_token = token_data.get("access_token")
-                user_data = await verify_google_id_token(id_token, client, google_access_token)
-                print(f"Verified user data: {user_data}")
-                
-            except Exception as e:
-                print(f"JWT verification error: {e}")
-                raise HTTPException(status_code=400, detail=f"Failed to verify ID token: {str(e)}")
-            
-            # Transform to expected format
-            user_data = {
-                "id": user_data["sub"],
-                "login": user_data.get("email", "").split("@")[0],
-                "name": user_data.get("name"),
-                "email": user_data.get("email"),
-                "avatar_url": user_data.get("picture")
-            }
-            
-            tokens = create_tokens(user_data)
-            
-            return {
-                "user": {
-                    "id": user_data["id"], 
-                    "username": user_data["login"],
-                    "name": user_data.get("name"),
-                    "email": user_data.get("email"),
-                    "avatar": user_data.get("avatar_url")
-                },
-                **tokens
-            }
     except Exception as e:
-        print(f"Google auth error: {e}")
-        import traceback
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=f"Internal error: {str(e)}")
+        logger.debug("JWT verification error: %s", e)
+        raise HTTPException(status_code=400, detail=f"Failed to verify ID token: {str(e)}")
+    
+    # Transform to expected format
+    user_data = {
+        "id": user_data["sub"],
+        "login": user_data.get("email", "").split("@")[0],
+        "name": user_data.get("name"),
+        "email": user_data.get("email"),
+        "avatar_url": user_data.get("picture")
+    }
+    
+    return create_tokens(user_data)
 
 @app.get("/auth/me")
 async def get_me(current_user = Depends(get_current_user)):
-    return {
-        "user": {
-            "id": current_user["sub"],
-            "username": current_user["username"],
-            "name": current_user.get("name", current_user["username"]),
-            "email": current_user.get("email"),
-            "avatar": current_user.get("avatar")
-        }
-    }
+    # Body is serialised once per token and replayed from the cache
+    return Response(current_user[1], media_type="application/json")
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # One process per core; the token caches are per-process, so each worker
+    # verifies a given token once. uvicorn picks uvloop/httptools when installed
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WORKERS", os.cpu_count() or 1))
+    )
\ No newline at end of file